@@ -1,11 +1,20 @@
 import os
+import numpy as np
 import pandas as pd
 import ast
+import random
+import re
 import time
 from tqdm import tqdm
 import lightkurve as lk
+from astroquery.mast import Observations
+import requests
+from requests.adapters import HTTPAdapter
 import sqlite3
-import multiprocessing
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 
 # Ensure the directory exists
@@ -16,115 +25,347 @@ os.makedirs(os.environ["MPLCONFIGDIR"], exist_ok=True)
 TEST_MODE = False  # Set to False for full processing
 TEST_LIMIT = 10 if TEST_MODE else None
 SSD_CACHE_DIR = "/mnt/data/TCEs_LCs"  # Replace with your SSD path
-MAX_WORKERS = 8
+TCES_CSV = "/mnt/data/tces.csv"
+CSV_CHUNKSIZE = 100_000  # Catalog rows parsed and written per chunk
+MAX_WORKERS = 64
+MAX_REQUESTS_PER_SECOND = 50  # Shared across all workers to avoid overloading MAST
+QUEUE_SIZE = 10000  # Pending per-TIC results waiting for the writer thread
+BATCH_SIZE = 500  # LightCurves rows per executemany/commit
+
+OBS_ID_PATTERN = re.compile(r"tess\d+-s(?P<sector>\d{4})-(?P<tic>\d{16})-\d+-s")
+RETRYABLE_STATUS = {429, 503}  # MAST asking us to slow down
+SQLITE_TYPES = {'b': 'INTEGER', 'i': 'INTEGER', 'u': 'INTEGER', 'f': 'REAL'}  # By NumPy dtype kind
+INSERT_LIGHTCURVES = "INSERT OR IGNORE INTO LightCurves (TIC, sector, path_to_fits) VALUES (?, ?, ?)"
+CREATE_LIGHTCURVES_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS lc_tic_sector ON LightCurves (TIC, sector)"
 
 
 # Configure lightkurve cache directory to SSD
 lk.conf.cache_dir = SSD_CACHE_DIR
-if not os.path.exists(SSD_CACHE_DIR):
-    os.makedirs(SSD_CACHE_DIR)
+os.makedirs(SSD_CACHE_DIR, exist_ok=True)
+
 
+def configure_http_session():
+    """Let all MAST requests reuse a pool of keep-alive connections."""
+    # Mount on the existing session: the MAST API helpers hold a reference to it.
+    # No adapter retries: retry_mast_call owns retrying, with rate limiting and jitter.
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=0)
+    Observations._session.mount("https://", adapter)
+    Observations._session.mount("http://", adapter)
 
-def get_exo_tic_sectors():
-    """Load TIC IDs and sectors of exoplanet hosts from CSV file."""
+
+def parse_sectors(sectors):
+    """Turn a Sectors field (a stringified list or a single value) into a list of ints; [] if malformed."""
     try:
-        df = pd.read_csv("/mnt/data/tces.csv")
-        tic_sectors = list(zip(df['tic_id'], df['Sectors']))
-        tic_sectors = [(tic, sectors) for tic, sectors in tic_sectors]
-        return tic_sectors
-    except Exception as e:
+        if isinstance(sectors, str):
+            sectors = ast.literal_eval(sectors)
+        if not isinstance(sectors, (list, tuple, set)):
+            sectors = [sectors]
+        return [int(sector) for sector in sectors]
+    except (ValueError, SyntaxError, TypeError):
         return []
 
-def download_tess_data(tic, sector, max_retries=3):
-    for attempt in range(max_retries):
+def get_exo_tic_sectors(df=None):
+    """Load TIC IDs and sectors of exoplanet hosts from a TCE frame or CSV file."""
+    if df is None:
         try:
-            search = lk.search_lightcurve(f"TIC {tic}", sector=sector)
-            if len(search) == 0:
+            df = pd.read_csv(TCES_CSV, usecols=['tic_id', 'Sectors'])
+        except (OSError, ValueError) as e:
+            return np.empty((0, 2), dtype='int64')
+    df = df[['tic_id', 'Sectors']].dropna(subset=['Sectors'])
+    # One (TIC, sector) row per sector, parsed once at load time; malformed rows explode to NaN
+    df = df.assign(Sectors=df['Sectors'].map(parse_sectors)).explode('Sectors').dropna()
+    return df.astype({'tic_id': 'int64', 'Sectors': 'int64'}).to_numpy()
 
-                return None
-            lc = search.download()
+def quote_identifier(name):
+    """Quote a column name for SQLite, doubling any embedded double quotes."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def sqlite_type(values):
+    """SQLite column type for a column of the first chunk; untyped if it is all null there."""
+    # An all-null column says nothing about later chunks, so let each value keep its own storage class
+    if values.isna().all():
+        return ""
+    return SQLITE_TYPES.get(values.dtype.kind, "TEXT")
+
+def write_tois(conn, df, replace=True):
+    """Write DataFrame rows to TOIs through one prepared INSERT, recreating the table if replace."""
+    cursor = conn.cursor()
+    names = ', '.join(quote_identifier(col) for col in df.columns)
+    placeholders = ', '.join('?' * len(df.columns))
+
+    if replace:
+        columns = ', '.join(f'{quote_identifier(col)} {sqlite_type(values)}'.rstrip() for col, values in df.items())
+        cursor.execute("DROP TABLE IF EXISTS TOIs")
+        cursor.execute(f"CREATE TABLE TOIs ({columns})")
+    cursor.executemany(f"INSERT INTO TOIs ({names}) VALUES ({placeholders})",
+                       df.itertuples(index=False, name=None))
+    conn.commit()
+
+def load_tces(conn):
+    """Stream the TCE catalog into the TOIs table and return its (TIC, sector) pairs."""
+    tic_sectors = []
+    # Each chunk feeds both consumers, so the CSV is parsed once without being held whole
+    for i, chunk in enumerate(pd.read_csv(TCES_CSV, chunksize=CSV_CHUNKSIZE)):
+        write_tois(conn, chunk.drop(columns='Sectors'), replace=(i == 0))
+        tic_sectors.append(get_exo_tic_sectors(chunk))
+    return np.concatenate(tic_sectors)
+
+def index_cached_fits(cache_dir):
+    """Map (TIC, sector) to already-downloaded SPOC light curves with one scan of the cache."""
+    # lightkurve stores products as mastDownload/TESS/<obs_id>/<obs_id>_lc.fits
+    cached = {}
+    try:
+        entries = os.scandir(os.path.join(cache_dir, "mastDownload", "TESS"))
+    except FileNotFoundError:
+        return cached
+    with entries:
+        for entry in entries:
+            match = OBS_ID_PATTERN.fullmatch(entry.name)
+            if match is None:
+                continue
+            path = os.path.join(entry.path, f"{entry.name}_lc.fits")
+            if os.path.isfile(path):
+                cached[(int(match.group("tic")), int(match.group("sector")))] = path
+    return cached
+
+class RateLimiter:
+    """Token bucket shared by the worker threads to cap the rate of MAST calls."""
+
+    def __init__(self, rate, per=1.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-            return lc
-        except (ConnectionError, TimeoutError) as e:
+    def acquire(self):
+        """Block until a call may be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * self.per / self.rate
+            time.sleep(wait)
 
-            if attempt < max_retries - 1:
-                sleep_time = 3 * (attempt + 1)
-                time.sleep(sleep_time)
+mast_rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+def retry_mast_call(func, max_retries=3):
+    """Call a MAST request, retrying on connection errors and throttling; None if it fails."""
+    for attempt in range(max_retries):
+        try:
+            mast_rate_limiter.acquire()
+            return func()
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code not in RETRYABLE_STATUS:
+                return None
+        except (ConnectionError, TimeoutError,
+                requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            pass
         except Exception as e:
 
             return None
 
+        if attempt < max_retries - 1:
+            # Exponential backoff with jitter so failing workers don't retry in lockstep
+            sleep_time = min(60, 3 * 2 ** attempt) * random.uniform(0.5, 1.5)
+            time.sleep(sleep_time)
+
     return None
 
+def search_for_tic(tic):
+    """Resolve a TIC on MAST and list its light curve products for all sectors."""
+    # Not cached: tasks are grouped by TIC, so each star is already searched only once per run
+    return lk.search_lightcurve(f"TIC {tic}")
+
+def download_tess_data(tic, sectors, max_retries=3):
+    """Search MAST once for a TIC and download its light curve for each sector."""
+    search = retry_mast_call(lambda: search_for_tic(tic), max_retries)
+    if search is None or len(search) == 0:
+        return []
+
+    lcs = []
+    for sector in sectors:
+        # download() takes the top-priority product, as the per-sector search did
+        sub = search[search.table['sequence_number'] == sector]
+        if len(sub) == 0:
+            continue
+        lc = retry_mast_call(sub.download, max_retries)
+        if lc is not None:
+            lcs.append((sector, lc))
+    return lcs
+
 def worker(task):
-    """Worker function to download light curve and return result."""
-    tic, sector = task
+    """Worker function to download one TIC's light curves and return result rows."""
+    tic, sectors = task
     try:
-        lc = download_tess_data(tic, sector)
-        if lc is not None:
-            file_path = lc.filename
-            return (tic, sector, file_path)
-        return None
+        return [(tic, sector, os.path.relpath(lc.filename, SSD_CACHE_DIR))
+                for sector, lc in download_tess_data(tic, sectors)]
     except Exception as e:
 
-        return None
+        return []
+
+def fits_path(path_to_fits):
+    """Absolute path of a LightCurves.path_to_fits value, which is stored relative to SSD_CACHE_DIR."""
+    # Absolute paths written by earlier runs are returned unchanged
+    return os.path.join(SSD_CACHE_DIR, path_to_fits)
+
+def has_legacy_tic_sector_index(cursor):
+    """Whether LightCurves has another unique index on (TIC, sector), like the old inline UNIQUE constraint."""
+    for _, name, unique, *_ in cursor.execute("PRAGMA index_list(LightCurves)").fetchall():
+        if not unique or name == 'lc_tic_sector':
+            continue
+        info = cursor.execute(f"PRAGMA index_info({quote_identifier(name)})").fetchall()
+        if [column.lower() for _, _, column in info] == ['tic', 'sector']:
+            return True
+    return False
+
+def ensure_lightcurves_index(cursor):
+    """Create lc_tic_sector, unless an existing unique index already enforces (TIC, sector)."""
+    if has_legacy_tic_sector_index(cursor):
+        # A second identical B-tree would only double the upkeep on every insert
+        cursor.execute("DROP INDEX IF EXISTS lc_tic_sector")
+    else:
+        cursor.execute(CREATE_LIGHTCURVES_INDEX)
+
+def insert_lightcurves(conn, cursor, rows):
+    """Insert a batch of (TIC, sector, relative path) rows in a single transaction."""
+    if not rows:
+        return
+    cursor.executemany(INSERT_LIGHTCURVES, rows)
+    conn.commit()
+
+def writer(conn, q):
+    """Drain result rows from the queue and write them in batches until a None sentinel."""
+    cursor = conn.cursor()
+    buf = []
+    while (rows := q.get()) is not None:
+        buf.extend(rows)
+
+        # Write in batches to balance speed and data safety
+        if len(buf) >= BATCH_SIZE:
+            insert_lightcurves(conn, cursor, buf)
+            buf.clear()
+
+    # Write any remaining rows
+    insert_lightcurves(conn, cursor, buf)
+
+def offer(q, writer_thread, item):
+    """Put an item on the writer queue; False if the writer dies before there is room."""
+    while writer_thread.is_alive():
+        try:
+            q.put(item, timeout=1.0)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def put_rows(q, writer_thread, rows):
+    """Queue rows for the writer, raising if it has died instead of blocking on a full queue."""
+    if not offer(q, writer_thread, rows):
+        # Raising cancels the pending downloads, whose rows could no longer be stored
+        raise RuntimeError("LightCurves writer thread stopped on a database error")
+
+def run_all(tasks, conn, cached_rows):
+    """Download all tasks on a thread pool while a writer thread stores the results."""
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    writer_thread = threading.Thread(target=writer, args=(conn, q))
+    writer_thread.start()
+
+    try:
+        if cached_rows:
+            put_rows(q, writer_thread, cached_rows)
+
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        completed = False
+        try:
+            futures = [executor.submit(worker, task) for task in tasks]
+
+            # Hand results to the writer so downloads never wait on SQLite
+            progress = tqdm(as_completed(futures), total=len(futures), desc="Downloading Light Curves",
+                            mininterval=1.0, miniters=100, smoothing=0, leave=False)
+            for future in progress:
+                rows = future.result()
+                if rows:
+                    put_rows(q, writer_thread, rows)
+            completed = True
+        finally:
+            # On Ctrl-C or an error, drop queued downloads instead of waiting for them
+            executor.shutdown(wait=completed, cancel_futures=not completed)
+    finally:
+        # The sentinel must not block either: the writer can die with the queue full
+        if offer(q, writer_thread, None):
+            writer_thread.join()
 
 def main():
     try:
         # Set up SQLite database
-        conn = sqlite3.connect('/mnt/data/tce_database.db')
+        # The connection is handed to the writer thread once setup is done
+        conn = sqlite3.connect('/mnt/data/tce_database.db', check_same_thread=False)
         cursor = conn.cursor()
 
-        # Create LightCurves table with unique constraint on (TIC, sector)
+        # WAL with relaxed sync avoids an fsync per batch commit
+        cursor.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-131072;
+            PRAGMA mmap_size=268435456;
+            PRAGMA busy_timeout=5000;
+        """)
+
+        # Create LightCurves table; uniqueness of (TIC, sector) comes from lc_tic_sector
+        # (or, in databases created by older versions, the inline UNIQUE constraint)
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS LightCurves (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             TIC INTEGER,
             sector INTEGER,
-            path_to_fits TEXT,
-            UNIQUE (TIC, sector)
+            path_to_fits TEXT
         )
         ''')
         conn.commit()
 
-        # Load TOI features from "tois.csv" and populate TOIs table
-        df_tois = pd.read_csv("/mnt/data/tces.csv")
-        features = [col for col in df_tois.columns if col != 'Sectors']
-        df_tois = df_tois[features]
-        df_tois.to_sql('TOIs', conn, if_exists='replace', index=False)
-
-        # Load TIC and sector data
+        # Populate the TOIs table and load TIC and sector data in one pass over the CSV
         if TEST_MODE:
-            test_exo = get_exo_tic_sectors()[:TEST_LIMIT]  # Process only 10 in test mode
+            test_exo = load_tces(conn)[:TEST_LIMIT]  # Process only 10 in test mode
         else:
-            test_exo = get_exo_tic_sectors()  # Full dataset
-
-        # Prepare tasks for parallel processing
-        tasks = [(tic, sectors) for tic, sectors in test_exo if sectors is not None]
-
-
-        # Use multiprocessing Pool with 8 workers
-        with multiprocessing.Pool(processes=MAX_WORKERS) as pool:
-            cursor.execute("BEGIN TRANSACTION")
-            processed_count = 0
-
-            # Process tasks in parallel, inserting results as they arrive
-            for result in tqdm(pool.imap_unordered(worker, tasks), total=len(tasks), desc="Downloading Light Curves"):
-                if result is not None:
-                    tic, sector, file_path = result
-                    cursor.execute("""
-                        INSERT INTO LightCurves (TIC, sector, path_to_fits) VALUES (?, ?, ?)
-                        ON CONFLICT(TIC, sector) DO UPDATE SET path_to_fits = excluded.path_to_fits
-                    """, (tic, sector, file_path))
-                    processed_count += 1
-
-                    # Commit every 100 inserts to balance speed and data safety
-                    if processed_count % 100 == 0:
-                        conn.commit()
-                        cursor.execute("BEGIN TRANSACTION")
-
-            # Commit any remaining inserts
-            conn.commit()
+            test_exo = load_tces(conn)  # Full dataset
+
+        # Pairs recorded by earlier runs need neither a download nor a write
+        existing = set(cursor.execute("SELECT TIC, sector FROM LightCurves").fetchall())
+
+        # An initial load builds the unique index once at the end instead of per insert
+        if existing:
+            ensure_lightcurves_index(cursor)
+        else:
+            cursor.execute("DROP INDEX IF EXISTS lc_tic_sector")
+        conn.commit()
+
+        # Light curves already on disk are recorded without touching MAST
+        cached = index_cached_fits(SSD_CACHE_DIR)
+        cached_rows = []
+
+        # Group the remaining sectors by TIC so each star needs a single MAST search
+        by_tic = defaultdict(list)
+        for tic, sector in {(int(tic), int(sector)) for tic, sector in test_exo} - existing:
+            if (tic, sector) in cached:
+                cached_rows.append((tic, sector, os.path.relpath(cached[(tic, sector)], SSD_CACHE_DIR)))
+            else:
+                by_tic[tic].append(sector)
+        tasks = [(tic, sorted(sectors)) for tic, sectors in by_tic.items()]
+
+
+        configure_http_session()
+
+        # Downloads are network-bound, so run them concurrently on threads
+        run_all(tasks, conn, cached_rows)
+
+        ensure_lightcurves_index(cursor)
+        conn.commit()
 
 
     except KeyboardInterrupt: